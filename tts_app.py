@@ -1,36 +1,77 @@
-import io
 import os
+import codecs
+import re
+import time
+import asyncio
 import uuid
 import base64
+import hashlib
+import inspect
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List
+from typing import BinaryIO, Callable, List, Optional
 
+import httpx
+import numpy as np
 import streamlit as st
-from openai import OpenAI
+from streamlit.errors import StreamlitAPIException
+from streamlit.runtime.media_file_storage import MediaFileStorageError
+from openai import (
+    OpenAI, AsyncOpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError,
+)
+from openai.resources.audio.speech import AsyncSpeech
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 
 # -----------------------
 # Config
 # -----------------------
 DEFAULT_MODEL = "gpt-4o-mini-tts"
-ALLOWED_VOICES = [
+VOICES = (
     "alloy", "echo", "fable", "onyx", "nova", "shimmer",
     "coral", "verse", "ballad", "ash", "sage", "marin", "cedar"
-]
+)  # display order for the selectbox
+ALLOWED_VOICES = frozenset(VOICES)
 MAX_CHARS_PER_CHUNK = 4000
+NUMPY_PACK_MIN_CHARS = 100_000  # below this the plain Python packer is as fast
+MAX_UPLOAD_BYTES = 2 * 1024 * 1024
+PREVIEW_CHARS = 2000
+UPLOAD_READ_BYTES = 64 * 1024
+MAX_JOBS = 4  # synthesis jobs running at once across all sessions
+POLL_SECONDS = 0.5
+# Simultaneous Speech API requests per synthesis; tune to your account's rate-limit tier
+DEFAULT_CONCURRENCY = 8
+_concurrency_env = os.environ.get("TTS_CONCURRENCY", str(DEFAULT_CONCURRENCY))
+try:
+    MAX_CONCURRENCY = max(1, int(_concurrency_env))  # 0 would deadlock the semaphore
+    _concurrency_warning = None
+except ValueError:
+    MAX_CONCURRENCY = DEFAULT_CONCURRENCY
+    _concurrency_warning = f"Ignoring invalid TTS_CONCURRENCY={_concurrency_env!r}; using {DEFAULT_CONCURRENCY}."
+STREAM_CHUNK_BYTES = 64 * 1024
+HTTP_TIMEOUT = 60.0
+HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=32)
 OUTPUT_DIR = Path("tts_outputs")
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+CACHE_DIR = OUTPUT_DIR / "cache"  # per-chunk MP3s, content-addressed
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+_SENT_RE = re.compile(r"(?<=[.!?])\s+")
+# SDKs name the output-format argument `format` or `response_format`; detect it once
+_SPEECH_FORMAT_KW = "format" if "format" in inspect.signature(AsyncSpeech.create).parameters else "response_format"
 
 st.set_page_config(page_title="TTS", page_icon="🔊", layout="centered")
 st.title("🔊 Text to Speech")
+if _concurrency_warning:
+    st.warning(_concurrency_warning)
 
 # -----------------------
 # Helpers
 # -----------------------
-def chunk_text(text: str, max_len: int = MAX_CHARS_PER_CHUNK) -> List[str]:
-    """Split text into roughly max_len-sized chunks on whitespace."""
+def _pack(pieces: List[str], max_len: int) -> List[str]:
+    """Greedily join pieces with single spaces into chunks of at most max_len."""
     chunks, buf = [], []
     length = 0
-    for part in text.split():
+    for part in pieces:
         add_len = len(part) + (1 if buf else 0)
         if length + add_len > max_len:
             if buf:
@@ -43,41 +84,179 @@ def chunk_text(text: str, max_len: int = MAX_CHARS_PER_CHUNK) -> List[str]:
         chunks.append(" ".join(buf))
     return chunks
 
-@st.cache_resource(show_spinner=False)
-def get_client():
+def _pack_np(pieces: List[str], max_len: int) -> List[str]:
+    """Same result as _pack, with split points found by searchsorted over cumulative lengths."""
+    # cum[k] = length of pieces[:k + 1], each counted with one joining space
+    cum = np.cumsum(np.fromiter(map(len, pieces), dtype=np.int64, count=len(pieces)) + 1)
+    chunks, start = [], 0
+    while start < len(pieces):
+        base = cum[start - 1] if start else 0
+        # " ".join(pieces[start:end]) has length cum[end - 1] - base - 1
+        end = int(np.searchsorted(cum, base + max_len + 1, side="right"))
+        end = max(end, start + 1)  # an oversized piece still gets its own chunk
+        chunks.append(" ".join(pieces[start:end]))
+        start = end
+    return chunks
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def chunk_text(text: str, max_len: int = MAX_CHARS_PER_CHUNK) -> List[str]:
+    """
+    Split text into chunks of at most max_len on sentence boundaries.
+    Sentences longer than max_len fall back to splitting on whitespace.
+    """
+    pieces = []
+    for sentence in _SENT_RE.split(text.strip()):
+        words = sentence.split()
+        if len(sentence) > max_len:
+            pieces.extend(words)
+        elif words:
+            pieces.append(" ".join(words))
+    pack = _pack_np if len(text) > NUMPY_PACK_MIN_CHARS else _pack
+    return pack(pieces, max_len)
+
+def get_api_key() -> str:
     key = os.environ.get("OPENAI_API_KEY") or st.secrets.get("OPENAI_API_KEY")
     if not key:
         st.error("Missing OPENAI_API_KEY (set in Secrets or environment).")
         st.stop()
-    return OpenAI(api_key=key)
+    return key
+
+@st.cache_resource(show_spinner=False)
+def get_client():
+    return OpenAI(api_key=get_api_key())
 
-def _tts_once(client, model: str, voice: str, text: str) -> bytes:
+@st.cache_data(ttl=300, show_spinner=False)
+def _preflight(model: str) -> bool:
     """
-    Call OpenAI Speech API. Supports SDKs that use `format` or `response_format`.
-    Returns raw MP3 bytes.
+    Cheap auth/model check before fanning out, so a bad key or model fails once
+    instead of once per chunk. Errors are raised (and not cached).
     """
+    get_client().models.retrieve(model)
+    return True
+
+def _content_key(model: str, voice: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\x00{voice}\x00{text}".encode()).hexdigest()
+
+def _cache_path(model: str, voice: str, text: str) -> Path:
+    return CACHE_DIR / f"{_content_key(model, voice, text)}.mp3"
+
+def _output_path(model: str, voice: str, text: str) -> Path:
+    """Same input, same file: regenerating identical text reuses the finished MP3."""
+    return OUTPUT_DIR / f"{voice}-{_content_key(model, voice, text)[:16]}.mp3"
+
+def _async_http_client() -> httpx.AsyncClient:
+    """Keep-alive HTTP/2 pool so chunks 2..N reuse one TLS connection."""
+    # Pool settings go on the transport: httpx ignores the client-level ones when a transport is given.
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=HTTP_LIMITS, retries=2)
+    return httpx.AsyncClient(timeout=HTTP_TIMEOUT, transport=transport)
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_random_exponential(multiplier=1, max=8),
+    # httpx.TransportError covers timeouts/disconnects while reading the streamed body,
+    # which the SDK passes through unwrapped
+    retry=retry_if_exception_type(
+        (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError, httpx.TransportError)
+    ),
+    reraise=True,
+)
+async def _stream_tts_async(client, model: str, voice: str, text: str, dest: Path, sem: asyncio.Semaphore):
+    """Stream one chunk from the OpenAI Speech API straight into `dest`."""
+    # Unique per attempt: concurrent jobs sharing a chunk must not write the same temp file
+    tmp = dest.with_name(f".{dest.name}.{uuid.uuid4().hex[:8]}.part")
     try:
-        r = client.audio.speech.create(model=model, voice=voice, input=text, format="mp3")
-    except TypeError:
-        r = client.audio.speech.create(model=model, voice=voice, input=text, response_format="mp3")
-
-    # Normalize to bytes across SDK variants
-    if hasattr(r, "content") and r.content is not None:
-        return r.content
-    if hasattr(r, "read"):
-        return r.read()
-    if isinstance(r, (bytes, bytearray)):
-        return bytes(r)
-    return getattr(r, "data", b"")
-
-def synthesize_tts(chunks: List[str], voice: str, model: str) -> bytes:
-    client = get_client()
-    out = io.BytesIO()
-    for chunk in chunks:
-        out.write(_tts_once(client, model, voice, chunk))
-    return out.getvalue()
-
-def render_audio(audio_bytes: bytes, file_name: str):
+        async with sem:
+            async with client.audio.speech.with_streaming_response.create(
+                model=model, voice=voice, input=text, **{_SPEECH_FORMAT_KW: "mp3"}
+            ) as r:
+                with open(tmp, "wb") as f:
+                    async for b in r.iter_bytes(STREAM_CHUNK_BYTES):
+                        f.write(b)
+        # Never publish (or report as ready) a chunk with no audio
+        if not tmp.stat().st_size:
+            raise ValueError(f"Speech API returned no audio for chunk {text[:40]!r}")
+        tmp.replace(dest)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+async def _synthesize_async(api_key: str, jobs: List[tuple], voice: str, model: str,
+                            on_ready: Callable[[str, Path], None]):
+    # The async client is bound to the event loop that asyncio.run() creates,
+    # so it lives for one synthesis rather than in st.cache_resource.
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def run(client, text: str, dest: Path):
+        await _stream_tts_async(client, model, voice, text, dest, sem)
+        on_ready(text, dest)
+
+    # Retries are handled per chunk by @retry on _stream_tts_async, not by the SDK
+    async with AsyncOpenAI(api_key=api_key, http_client=_async_http_client(), max_retries=0) as client:
+        await asyncio.gather(*(run(client, text, dest) for text, dest in jobs))
+
+def synthesize_tts(chunks: List[str], voice: str, model: str, out: BinaryIO, api_key: str,
+                   on_ready: Optional[Callable[[int, Path], None]] = None) -> None:
+    """
+    Synthesize chunks and append the MP3 audio to `out` in chunk order.
+    Repeated chunks are synthesized once, and only chunks missing from the disk
+    cache hit the API; `on_ready(index, path)` is called as each chunk becomes available.
+    Makes no Streamlit calls, so it can run on a worker thread.
+    """
+    positions = {}
+    for i, c in enumerate(chunks):
+        positions.setdefault(c, []).append(i)
+    paths = {c: _cache_path(model, voice, c) for c in positions}
+
+    def ready(text: str, path: Path):
+        if on_ready:
+            for i in positions[text]:
+                on_ready(i, path)
+
+    missing = []
+    for c, p in paths.items():
+        if p.exists():
+            ready(c, p)
+        else:
+            missing.append((c, p))
+    if missing:
+        asyncio.run(_synthesize_async(api_key, missing, voice, model, ready))
+    # A gap would yield a truncated MP3 that later gets served as finished
+    absent = [c for c, p in paths.items() if not p.exists()]
+    if absent:
+        raise FileNotFoundError(f"No cached audio for {len(absent)} chunk(s), e.g. {absent[0][:40]!r}")
+    # Chunk order is restored here; writelines pulls one chunk file at a time
+    out.writelines(paths[c].read_bytes() for c in chunks)
+
+@st.cache_resource(show_spinner=False)
+def get_executor() -> ThreadPoolExecutor:
+    # Shared by all sessions; module-level state would be recreated on every rerun
+    return ThreadPoolExecutor(max_workers=MAX_JOBS)
+
+def _run_job(chunks: List[str], voice: str, model: str, api_key: str, path: Path,
+             progress: dict) -> Optional[Path]:
+    """
+    Worker-thread body: synthesize into `path`, recording progress for the UI to poll.
+    Returns None if no audio came back.
+    """
+    def on_ready(i: int, chunk_path: Path):
+        progress["done"] += 1
+        if i == 0:
+            progress["first"] = chunk_path
+
+    # Build under a temporary name so a failed job never leaves a "finished" file behind
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.part")
+    try:
+        with open(tmp, "wb") as out:
+            synthesize_tts(chunks, voice, model, out, api_key, on_ready)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    if not tmp.stat().st_size:
+        tmp.unlink()
+        return None
+    tmp.replace(path)
+    return path
+
+def render_audio(path: Path):
     """
     Primary player: Streamlit audio with proper MIME for iOS.
     Fallback: raw HTML5 <audio> tag (more tolerant on mobile).
@@ -85,14 +264,22 @@ def render_audio(audio_bytes: bytes, file_name: str):
     """
     ok = False
     try:
-        # Safari expects standards-compliant MIME
-        st.audio(io.BytesIO(audio_bytes), format="audio/mpeg")
+        # Safari expects standards-compliant MIME; a path lets Streamlit serve the file itself
+        st.audio(str(path), format="audio/mpeg")
         ok = True
-    except Exception as e:
+    except (StreamlitAPIException, MediaFileStorageError) as e:
         st.caption(f"Player error: {e}")
 
-    if not ok:
-        b64 = base64.b64encode(audio_bytes).decode()
+    # Once the native player has worked in this session, never build the base64 copy
+    if ok:
+        st.session_state.player_ok = True
+    elif not st.session_state.get("player_ok"):
+        # Encode once per file (render_audio runs again on every rerun); keep only
+        # the current file's string so old outputs don't pile up in session memory
+        cached = st.session_state.get("b64")
+        if cached is None or cached[0] != path.name:
+            cached = st.session_state.b64 = (path.name, base64.b64encode(path.read_bytes()).decode())
+        b64 = cached[1]
         st.markdown(
             f"""
             <audio controls style="width:100%">
@@ -103,7 +290,8 @@ def render_audio(audio_bytes: bytes, file_name: str):
             unsafe_allow_html=True,
         )
 
-    st.download_button("Download MP3", audio_bytes, file_name=file_name, mime="audio/mpeg")
+    with open(path, "rb") as f:
+        st.download_button("Download MP3", f, file_name=path.name, mime="audio/mpeg")
 
 # -----------------------
 # Input Section (Text OR .txt file)
@@ -112,38 +300,88 @@ st.subheader("Input Text")
 uploaded_file = st.file_uploader("Upload a .txt file (optional)", type=["txt"])
 
 if uploaded_file is not None:
-    text = uploaded_file.read().decode("utf-8", errors="ignore")
+    if uploaded_file.size > MAX_UPLOAD_BYTES:
+        st.error(f"File too large ({uploaded_file.size} bytes); limit is {MAX_UPLOAD_BYTES} bytes.")
+        st.stop()
+    # Decode in bounded pieces so the whole file never exists as one bytes copy
+    uploaded_file.seek(0)
+    pieces = iter(lambda: uploaded_file.read(UPLOAD_READ_BYTES), b"")
+    text = "".join(codecs.iterdecode(pieces, "utf-8", errors="ignore"))
     st.success("✅ Text file loaded.")
-    st.text_area("Preview File Content", text, height=200)
+    preview = text if len(text) <= PREVIEW_CHARS else text[:PREVIEW_CHARS] + "\n(…file truncated for preview)"
+    st.text_area("Preview File Content", preview, height=200)
 else:
     text = st.text_area("Or enter text manually:", placeholder="Type or paste text here...", height=200)
 
 # Voice / Model selection
 col1, col2 = st.columns(2)
 with col1:
-    voice = st.selectbox("Voice", ALLOWED_VOICES, index=0)
+    voice = st.selectbox("Voice", VOICES, index=0)
 with col2:
     model = st.text_input("Model", value=DEFAULT_MODEL)
 
-# Generate
-gen = st.button("Generate", type="primary", disabled=not text.strip())
-
-if gen:
-    with st.spinner("Synthesizing..."):
-        try:
-            chunks = chunk_text(text)
-            st.caption(f"Chunked into {len(chunks)} piece(s)")
-            audio_bytes = synthesize_tts(chunks, voice, model)
-            size = len(audio_bytes)
-            st.caption(f"Generated {size} bytes")
-            if size == 0:
-                st.error("No audio returned. Check API key, model name, or logs.")
-            else:
-                fname = f"{voice}-{uuid.uuid4().hex[:8]}.mp3"
-                (OUTPUT_DIR / fname).write_bytes(audio_bytes)
-                st.success("Done!")
-                render_audio(audio_bytes, fname)
-        except Exception as e:
-            st.error(f"Error while generating audio: {e}")
+# Generate (disabled while this session's job is still running, so it isn't paid for twice)
+running = "job" in st.session_state and not st.session_state.job["future"].done()
+gen = st.button("Generate", type="primary", disabled=running or not text.strip())
+
+if gen and not running:
+    # Reject a bad voice locally rather than paying for an API round-trip that 400s;
+    # the free-text model is checked by _preflight
+    model = model.strip()
+    if voice not in ALLOWED_VOICES:
+        st.error(f"Unknown voice: {voice!r}")
+        st.stop()
+    path = _output_path(model, voice, text)
+    if path.exists():
+        # Identical request already synthesized: skip chunking and the API entirely
+        st.session_state.pop("job", None)
+        st.session_state.result = path
+        st.rerun()
+    try:
+        chunks = chunk_text(text)
+        _preflight(model)
+    except Exception as e:
+        st.error(f"Error while generating audio: {e}")
+        st.stop()
+    progress = {"done": 0, "total": len(chunks), "first": None}
+    future = get_executor().submit(_run_job, chunks, voice, model, get_api_key(), path, progress)
+    st.session_state.job = {"future": future, "progress": progress}
+    st.session_state.pop("result", None)
+    st.rerun()
+
+# Poll the background job; the session stays responsive while it runs
+job = st.session_state.get("job")
+if job is not None:
+    future, progress = job["future"], job["progress"]
+    done, total = progress["done"], progress["total"]
+    if not future.done():
+        st.caption(f"Chunked into {total} piece(s)")
+        st.progress(done / total, text=f"{done}/{total} chunks")
+        first = progress["first"]
+        if first is not None and total > 1 and first.exists():
+            # Play chunk 0 while the rest synthesize; a player error must not stop the polling
+            try:
+                st.audio(str(first), format="audio/mpeg")
+            except (StreamlitAPIException, MediaFileStorageError):
+                pass
+        with st.spinner("Synthesizing..."):
+            time.sleep(POLL_SECONDS)
+        st.rerun()
+    del st.session_state.job
+    try:
+        path = future.result()
+    except Exception as e:
+        st.error(f"Error while generating audio: {e}")
+    else:
+        if path is None:
+            st.error("No audio returned. Check API key, model name, or logs.")
+        else:
+            st.session_state.result = path
+
+result = st.session_state.get("result")
+if result is not None and result.exists():
+    st.caption(f"Generated {result.stat().st_size} bytes")
+    st.success("Done!")
+    render_audio(result)
 
 st.caption("Set OPENAI_API_KEY in Secrets (Streamlit Cloud) or as an environment variable.")